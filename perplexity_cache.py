@@ -0,0 +1,61 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+import orjson
+
+# Cached answers are research summaries with live citations, so let them age out
+DEFAULT_TTL = 7 * 24 * 60 * 60
+
+_WHITESPACE = re.compile(r'\s+')
+
+def prompt_key(prompt):
+    normalized = _WHITESPACE.sub(' ', prompt).strip().casefold()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+class PerplexityCache:
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Streamlit serves sessions from several threads, all sharing this instance
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response BLOB NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)"
+        )
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                return None
+            self.hits += 1
+            return orjson.loads(row[0])
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            # Drop everything that has aged out so the file does not grow without bound
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                (key, orjson.dumps(response), now)
+            )
+            self._conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -1,34 +1,54 @@
 import streamlit as st
 import os
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import PromptTemplate
-from langchain.chains import LLMChain
 import re
 import random
+import asyncio
+import threading
+import aiohttp
 import requests
-import json
-
-
-# Set the API keys
-GOOGLE_API_KEY = st.secrets["GOOGLE_API_KEY"] 
-PERPLEXITY_API_KEY = st.secrets["PERPLEXITY_API_KEY"]
-
-if not GOOGLE_API_KEY or not PERPLEXITY_API_KEY:
-    raise ValueError("API keys not found. Please set GOOGLE_API_KEY and PERPLEXITY_API_KEY in your .env file.")
-
-# Initialize the language model
-llm = ChatGoogleGenerativeAI(
-    model="gemini-pro",
-    temperature=0,
-    max_output_tokens=None,
-    timeout=None,
-    max_retries=2,
-)
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import orjson
+from perplexity_cache import PerplexityCache, prompt_key
+
+
+_CAT_SPLIT = re.compile(r'\*\*\d+\.\s+')
+_BLANK_LINES = re.compile(r'\n+')
+_URL_RE = re.compile(r'(https?://\S+)')
+_REFERENCES_RE = re.compile(r'References:|Sources:|Citation:|Bibliography:', re.IGNORECASE)
+# Longest label minus one: a tail this long may still be the start of a label
+_REFERENCES_HOLDBACK = len("Bibliography:") - 1
+# Captures the field label and its value already stripped of surrounding whitespace;
+# tolerates indented bullets and any run of spaces after the '*'
+_FIELD_RE = re.compile(r'\s*\*\s+\*\*(Description|Research Prompt|Key Concepts):\*\*\s*(.*?)\s*$')
+
+# Read the API keys on first use rather than on every rerun
+@st.cache_resource
+def get_api_key(name):
+    api_key = st.secrets.get(name)
+    if not api_key:
+        raise ValueError(f"API key not found. Please set {name} in your Streamlit secrets.")
+    return api_key
+
+# Initialize the language model on first use, so reruns and the Perplexity-only
+# mode skip importing langchain
+@st.cache_resource
+def get_llm():
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(
+        model="gemini-2.5-flash",
+        google_api_key=get_api_key("GOOGLE_API_KEY"),
+        temperature=0,
+        # 2.5 Flash thinks by default; switch it off to keep the latency and
+        # plain structured output the old model gave
+        thinking_budget=0,
+        max_output_tokens=None,
+        timeout=None,
+        max_retries=2,
+    )
 
 # Define the prompt template
-RESEARCH_PROMPT = PromptTemplate(
-    input_variables=["research_field", "research_topic"],
-    template="""
+RESEARCH_PROMPT_TEMPLATE = """
 You are an expert research consultant specializing in {research_field}. Your task is to generate research categories and prompts based on a given research topic.
 
 Given research topic: {research_topic}
@@ -53,22 +73,27 @@ Constraints:
 
 Based on the above guidelines, provide your structured research categories and prompts below:
 """
-)
 
 def parse_research_categories(text):
-    categories = re.split(r'\*\*\d+\.\s+', text)[1:]
+    categories = _CAT_SPLIT.split(text)[1:]
     research_dict = {}
     for category in categories:
         lines = category.strip().split('\n')
         category_name = lines[0].strip('*')
-        details = {}
+        # Lowercased forms are kept alongside the originals for prompt sampling
+        details = {'category_lower': category_name.lower()}
         for line in lines[1:]:
-            if line.startswith('* **Description:**'):
-                details['description'] = line.split('**Description:**')[1].strip()
-            elif line.startswith('* **Research Prompt:**'):
-                details['research_prompt'] = line.split('**Research Prompt:**')[1].strip().strip('*')
-            elif line.startswith('* **Key Concepts:**'):
-                details['key_concepts'] = [concept.strip() for concept in line.split('**Key Concepts:**')[1].strip().split(',')]
+            m = _FIELD_RE.match(line)
+            if not m:
+                continue
+            field, value = m.group(1, 2)
+            if field == 'Description':
+                details['description'] = value
+            elif field == 'Research Prompt':
+                details['research_prompt'] = value.strip('*')
+            else:
+                details['key_concepts'] = [concept.strip() for concept in value.split(',')]
+                details['key_concepts_lower'] = [concept.lower() for concept in details['key_concepts']]
         research_dict[category_name] = details
     return research_dict
 
@@ -91,8 +116,25 @@ def create_prompt(topic, depth, focus):
     Be precise and concise in your explanations. And for the citation or references, provide links."""
     return prompt
 
-def query_perplexity(prompt, api_key):
-    url = "https://api.perplexity.ai/chat/completions"
+PERPLEXITY_URL = "https://api.perplexity.ai/chat/completions"
+PERPLEXITY_CACHE_PATH = "perplexity_cache.sqlite"
+PERPLEXITY_BATCH_TIMEOUT = 120
+# Requests in flight at once; beyond this Perplexity starts answering with 429s
+PERPLEXITY_MAX_CONCURRENCY = 5
+
+@st.cache_resource
+def get_session():
+    # Shared across reruns so keep-alive connections to Perplexity are reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_perplexity_cache():
+    return PerplexityCache(PERPLEXITY_CACHE_PATH)
+
+def build_perplexity_request(prompt, api_key):
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -105,83 +147,261 @@ def query_perplexity(prompt, api_key):
         ],
         "max_tokens": 2000,
         "temperature": 0.2,
-        "return_citations": True
+        "return_citations": True,
+        "stream": True
     }
+    return headers, data
+
+def parse_stream_line(line):
+    # Perplexity streams server-sent events, one "data: {...}" chunk per line
+    if not line.startswith(b"data:"):
+        return None
+    payload = line[len(b"data:"):].strip()
+    if not payload or payload == b"[DONE]":
+        return None
+    return orjson.loads(payload)
+
+def stream_delta(chunk):
+    choices = chunk.get('choices') or [{}]
+    return choices[0].get('delta', {}).get('content') or ""
+
+def assemble_stream_response(last_chunk, parts):
+    # The final chunk carries the id, citations and usage; rebuild the
+    # non-streaming response shape around the concatenated content
+    if last_chunk is None:
+        return None
+    response = dict(last_chunk)
+    response['choices'] = [{"message": {"role": "assistant", "content": "".join(parts)}}]
+    return response
+
+def stream_perplexity(prompt, api_key, result):
+    # Yields content as it arrives; the assembled response is left in result["response"]
+    cache = get_perplexity_cache()
+    key = prompt_key(prompt)
+    cached = cache.get(key)
+    if cached is not None:
+        result["response"] = cached
+        yield cached['choices'][0]['message']['content']
+        return
+    result["response"] = None
+    headers, data = build_perplexity_request(prompt, api_key)
+    parts = []
+    last_chunk = None
+    try:
+        with get_session().post(PERPLEXITY_URL, headers=headers, data=orjson.dumps(data), timeout=30, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                chunk = parse_stream_line(line)
+                if chunk is None:
+                    continue
+                last_chunk = chunk
+                delta = stream_delta(chunk)
+                if delta:
+                    parts.append(delta)
+                    yield delta
+    # ValueError covers a malformed stream chunk (orjson.JSONDecodeError)
+    except (requests.RequestException, ValueError) as e:
+        st.error(f"Error querying Perplexity AI: {str(e)}")
+        return
+    result["response"] = assemble_stream_response(last_chunk, parts)
+    if result["response"] is not None:
+        cache.put(key, result["response"])
+
+async def query_perplexity_async(session, semaphore, prompt, api_key, placeholder):
+    cache = get_perplexity_cache()
+    key = prompt_key(prompt)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    headers, data = build_perplexity_request(prompt, api_key)
+    parts = []
+    last_chunk = None
+    # Per-read timeouts like requests' timeout=30; a total cap would cut off long streams
+    timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=30)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+        # Only live requests count toward the concurrency limit; cache hits returned above
+        async with semaphore, session.post(PERPLEXITY_URL, headers=headers, data=orjson.dumps(data), timeout=timeout) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                chunk = parse_stream_line(line)
+                if chunk is None:
+                    continue
+                last_chunk = chunk
+                delta = stream_delta(chunk)
+                if delta:
+                    parts.append(delta)
+                    placeholder.markdown("".join(parts))
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
         st.error(f"Error querying Perplexity AI: {str(e)}")
         return None
-
-def format_output(response):
+    result = assemble_stream_response(last_chunk, parts)
+    if result is not None:
+        cache.put(key, result)
+    return result
+
+def open_perplexity_session():
+    # One shared session so the concurrent requests reuse pooled connections and resolved DNS
+    connector = aiohttp.TCPConnector(limit=16, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector)
+
+async def gather_within_timeout(tasks, timeout=PERPLEXITY_BATCH_TIMEOUT):
+    # Bound the whole batch, keeping whatever finished in time
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        st.warning(f"{len(pending)} research queries did not finish within {timeout} seconds.")
+    return [task.result() if task in done else None for task in tasks]
+
+async def run_in_thread(func, *args):
+    # Carry the script context into the worker so Streamlit's caches work there as usual
+    ctx = get_script_run_ctx()
+    def call():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+    return await asyncio.to_thread(call)
+
+def split_references(content):
+    # Try to split content into main body and references; the label itself is
+    # dropped since process_references adds its own heading
+    m = _REFERENCES_RE.search(content)
+    if not m:
+        return content, ""
+    return content[:m.start()].strip(), content[m.end():].strip()
+
+def iter_main_content(deltas):
+    # Forward streamed content up to the answer's references section, which is
+    # rendered with linked URLs once the stream completes
+    buffered = ""
+    for delta in deltas:
+        buffered += delta
+        m = _REFERENCES_RE.search(buffered)
+        if m:
+            if m.start():
+                yield buffered[:m.start()]
+            # Drain the rest so the stream completes and its response is cached
+            for _ in deltas:
+                pass
+            return
+        if len(buffered) > _REFERENCES_HOLDBACK:
+            yield buffered[:-_REFERENCES_HOLDBACK]
+            buffered = buffered[-_REFERENCES_HOLDBACK:]
+    if buffered:
+        yield buffered
+
+def format_header():
+    return "Research Results:"
+
+def format_sources(response, references=""):
+    # Process references to create hyperlinks, falling back to the API's citation list
+    if references:
+        return process_references(references)
+    return format_citations(response.get('citations'))
+
+def render_output(response):
+    # Emit the pieces as separate elements instead of building one formatted copy
     if not response:
-        return "No response received from Perplexity AI."
-    content = response['choices'][0]['message']['content']
-    
-    # Try to split content into main body and references
-    parts = re.split(r'(References:|Sources:|Citation:|Bibliography:)', content, flags=re.IGNORECASE)
-    
-    if len(parts) > 1:
-        main_content = parts[0].strip()
-        references = "".join(parts[1:]).strip()
-    else:
-        main_content = content
-        references = ""
-
-    # Process references to create hyperlinks
-    processed_references = process_references(references)
-
-    formatted_output = f"""
-Research Results:
-
-{main_content}
-
-{processed_references}
-"""
-    return formatted_output
+        st.markdown("No response received from Perplexity AI.")
+        return
+    main_content, references = split_references(response['choices'][0]['message']['content'])
+    st.markdown(format_header())
+    st.markdown(main_content)
+    sources = format_sources(response, references)
+    if sources:
+        st.markdown(sources)
 
 def process_references(references):
     if not references:
         return ""
 
     # Split references into individual items
-    ref_list = re.split(r'\n+', references)
-    processed_refs = []
-
-    for ref in ref_list:
-        # Use regex to find URLs in the reference
-        urls = re.findall(r'(https?://\S+)', ref)
-        if urls:
-            # If URL found, create a hyperlink
-            for url in urls:
-                ref = ref.replace(url, f'[{url}]({url})')
-        processed_refs.append(ref)
+    ref_list = _BLANK_LINES.split(references)
+
+    # Link every URL of each reference in a single substitution pass
+    processed_refs = [_URL_RE.sub(r'[\1](\1)', ref) for ref in ref_list]
 
     return "References:\n" + '\n'.join(processed_refs)
 
+def format_citations(citations):
+    # Citations arrive either as bare URLs or as objects with a 'url' field
+    urls = [c if isinstance(c, str) else c.get('url') for c in citations or []]
+    sources = '\n'.join(f"{i}. [{url}]({url})" for i, url in enumerate(filter(None, urls), 1))
+    return f"Sources:\n{sources}" if sources else ""
+
 def generate_research_prompts(research_dict, num_prompts=4):
     prompts = []
     categories = list(research_dict.keys())
-    for _ in range(num_prompts):
-        category = random.choice(categories)
-        category_data = research_dict[category]
-        if random.choice([True, False]):
-            prompt = category_data['research_prompt']
+    concepts_by_category = {category: tuple(details.get('key_concepts_lower', ())) for category, details in research_dict.items()}
+    sampled = random.choices(categories, k=num_prompts)
+    # One random bit per prompt decides between the category prompt and a concept question
+    flips = random.getrandbits(num_prompts) if num_prompts else 0
+    for i, category in enumerate(sampled):
+        if (flips >> i) & 1:
+            prompt = research_dict[category]['research_prompt']
         else:
-            concepts = category_data['key_concepts']
-            concept = random.choice(concepts)
-            prompt = f"How can {concept.lower()} be applied in {category.lower()} to improve solar farm efficiency?"
+            concept = random.choice(concepts_by_category[category])
+            category_lower = research_dict[category]['category_lower']
+            prompt = f"How can {concept} be applied in {category_lower} to improve solar farm efficiency?"
         prompts.append(prompt)
     return prompts
 
-# Create the chain
-chain = LLMChain(llm=llm, prompt=RESEARCH_PROMPT)
-
-# Function to run the chain
+# Create the chain once per process and share it across sessions
+@st.cache_resource
+def get_chain():
+    from langchain_core.prompts import PromptTemplate
+    from langchain.chains import LLMChain
+    prompt = PromptTemplate(
+        input_variables=["research_field", "research_topic"],
+        template=RESEARCH_PROMPT_TEMPLATE
+    )
+    return LLMChain(llm=get_llm(), prompt=prompt)
+
+# Function to run the chain; temperature=0 makes the output safe to memoize
+@st.cache_data(show_spinner=False, ttl=3600, max_entries=256)
 def generate_research_categories(research_field, research_topic):
-    return chain.run(research_field=research_field, research_topic=research_topic)
+    return get_chain().run(research_field=research_field, research_topic=research_topic)
+
+async def research_pipeline(research_field, research_topic, num_prompts, depth, api_key, prompts_area, results_area):
+    async with open_perplexity_session() as session:
+        semaphore = asyncio.Semaphore(PERPLEXITY_MAX_CONCURRENCY)
+        placeholders = []
+        result_prompts = []
+        tasks = {}
+
+        def start_query(prompt):
+            # Open the first result so its streamed output is visible as it arrives
+            with results_area.expander(f"Research Result {len(placeholders) + 1}", expanded=not placeholders):
+                placeholders.append(st.empty())
+            full_prompt = create_prompt(prompt, depth, research_field)
+            result_prompts.append(full_prompt)
+            # Repeated prompts share one request; its response is fanned back out below
+            if full_prompt not in tasks:
+                tasks[full_prompt] = asyncio.create_task(query_perplexity_async(session, semaphore, full_prompt, api_key, placeholders[-1]))
+
+        # The topic itself is the first of the research prompts, so its query
+        # streams while Gemini is still generating the categories for the rest
+        research_prompts = [research_topic]
+        start_query(research_topic)
+        if num_prompts > 1:
+            with prompts_area, st.spinner("Generating research prompts..."):
+                result = await run_in_thread(generate_research_categories, research_field, research_topic)
+            res = parse_research_categories(result)
+            research_prompts += generate_research_prompts(res, num_prompts - 1)
+            for prompt in research_prompts[1:]:
+                start_query(prompt)
+
+        with prompts_area:
+            st.subheader("Research Prompts:")
+            for i, prompt in enumerate(research_prompts, 1):
+                st.write(f"{i}. {prompt}")
+
+        with results_area, st.spinner(f"Researching {len(tasks)} prompts..."):
+            responses = dict(zip(tasks, await gather_within_timeout(list(tasks.values()))))
+
+    for placeholder, full_prompt in zip(placeholders, result_prompts):
+        with placeholder.container():
+            render_output(responses[full_prompt])
 
 # Streamlit app
 st.set_page_config(page_title="Research Prompt Generator and Query System", page_icon="📚", layout="wide")
@@ -192,49 +412,49 @@ st.title("Research Prompt Generator and Query System")
 app_mode = st.sidebar.selectbox("Choose the app mode",
     ["Generate Research Prompts", "Direct Perplexity AI Query"])
 
+# Inputs live in forms so editing them does not rerun the whole script;
+# only submitting does
 if app_mode == "Generate Research Prompts":
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        research_field = st.text_input("Enter the research field:", "Using Sustainable methods to provide maintenance in solar farms")
-        research_topic = st.text_input("Enter the research topic:", "HOW CAN WE USE DRONES IN SYSTEMS?")
-    
-    with col2:
-        num_prompts = st.slider("Number of prompts to generate:", 1, 10, 4)
-        depth = st.slider("Depth of research:", 1, 5, 3)
-
-    if st.button("Generate Research Prompts and Query"):
-        with st.spinner("Generating research prompts..."):
-            result = generate_research_categories(research_field, research_topic)
-            res = parse_research_categories(result)
-            research_prompts = generate_research_prompts(res, num_prompts)
+    with st.form("research_prompts_form"):
+        col1, col2 = st.columns(2)
+
+        with col1:
+            research_field = st.text_input("Enter the research field:", "Using Sustainable methods to provide maintenance in solar farms")
+            research_topic = st.text_input("Enter the research topic:", "HOW CAN WE USE DRONES IN SYSTEMS?")
 
-        st.subheader("Generated Research Prompts:")
-        for i, prompt in enumerate(research_prompts, 1):
-            st.write(f"{i}. {prompt}")
+        with col2:
+            num_prompts = st.slider("Number of prompts to research:", 1, 10, 4,
+                                    help="The research topic itself is the first prompt; the rest are generated from it.")
+            depth = st.slider("Depth of research:", 1, 5, 3)
 
+        submitted = st.form_submit_button("Generate Research Prompts and Query")
+
+    if submitted:
+        prompts_area = st.container()
         st.subheader("Research Results:")
-        for i, prompt in enumerate(research_prompts, 1):
-            with st.spinner(f"Researching prompt {i}..."):
-                full_prompt = create_prompt(prompt, depth, research_field)
-                response = query_perplexity(full_prompt, PERPLEXITY_API_KEY)
-                formatted_result = format_output(response)
-                
-                with st.expander(f"Research Result {i}"):
-                    st.markdown(formatted_result)
+        results_area = st.container()
+        asyncio.run(research_pipeline(research_field, research_topic, num_prompts, depth,
+                                      get_api_key("PERPLEXITY_API_KEY"), prompts_area, results_area))
 
 elif app_mode == "Direct Perplexity AI Query":
     st.subheader("Direct Perplexity AI Query")
-    user_prompt = st.text_area("Enter your research prompt:", 
-        "Explain the impact of artificial intelligence on renewable energy systems.")
-    
-    if st.button("Query Perplexity AI"):
-        with st.spinner("Querying Perplexity AI..."):
-            response = query_perplexity(user_prompt, PERPLEXITY_API_KEY)
-            formatted_result = format_output(response)
-            
+    with st.form("direct_query_form"):
+        user_prompt = st.text_area("Enter your research prompt:",
+            "Explain the impact of artificial intelligence on renewable energy systems.")
+        submitted = st.form_submit_button("Query Perplexity AI")
+
+    if submitted:
         st.subheader("Research Result:")
-        st.markdown(formatted_result)
+        result = {}
+        st.markdown(format_header())
+        st.write_stream(iter_main_content(stream_perplexity(user_prompt, get_api_key("PERPLEXITY_API_KEY"), result)))
+        # Append the sources once the stream completes, as render_output does
+        response = result.get("response")
+        if response is not None:
+            _, references = split_references(response['choices'][0]['message']['content'])
+            sources = format_sources(response, references)
+            if sources:
+                st.markdown(sources)
 
 # Add some information about the app
 st.sidebar.title("About")
@@ -246,3 +466,6 @@ st.sidebar.info(
     "and get results directly from Perplexity AI.\n\n"
     "Choose your mode in the dropdown above."
 )
+
+cache_stats = get_perplexity_cache().stats()
+st.sidebar.caption(f"Perplexity cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")